@@ -1,9 +1,94 @@
+import io
+import lxml.html
+import random
 import re
+import time
 
-from bs4 import BeautifulSoup
+from concurrent.futures import Future, ThreadPoolExecutor
 from googleapiclient.discovery import Resource
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest, MediaIoBaseDownload
 from logging import Logger
-from typing import List
+from lxml import etree
+from operator import itemgetter
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence
+)
+
+# Extracts folder ids from links in HTML exported through the Google
+# Drive API
+_FOLDER_ID_RE = re.compile(r'q=https://drive\.google\.com/.*/folders/([^&?]+)')
+
+# Selects the n-th (1-indexed) table that is not nested in another table
+_NTH_TABLE_XPATH = etree.XPath('(//table[not(ancestor::table)])[$n]')
+
+# Selects the links within an element that may be to Google Drive
+# folders, so that other links are skipped without leaving libxml2
+_FOLDER_LINKS_XPATH = etree.XPath(
+    './/a[contains(@href, \'q=https://drive.google.com/\') '
+    'and contains(@href, \'/folders/\')]'
+)
+
+# Size of the chunks in which the agenda export is downloaded and parsed
+_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Maximum number of calls the Drive API accepts in a single batch request
+_MAX_BATCH_SIZE = 100
+
+# Maximum number of files the Drive API returns in a single list response
+_MAX_PAGE_SIZE = 1000
+
+# Number of times a Drive API request is retried after a rate limit or
+# server error
+_NUM_RETRIES = 5
+
+# Reasons given by the Drive API for 403 responses caused by rate limiting
+_RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+
+# Maximum number of threads used for concurrent Drive API calls
+_MAX_WORKERS = 8
+
+
+def _is_retryable(error: HttpError) -> bool:
+    '''
+    Returns whether a failed Drive API request should be retried
+
+    Args:
+        error (HttpError): the error raised by the request
+
+    Returns:
+        bool: True if the request failed because of rate limiting or a
+            server error
+    '''
+    status = error.resp.status
+    if status == 429 or status >= 500:
+        return True
+    return status == 403 and any(
+        reason in error.content for reason in _RATE_LIMIT_REASONS
+    )
+
+
+class Folder(NamedTuple):
+    '''
+    A Google Drive folder linked in an agenda file
+    '''
+    id: str
+    name: str
+
+
+class FileRef(NamedTuple):
+    '''
+    A Google Drive file with a name containing at least one keyword
+    '''
+    id: str
+    name: str
 
 
 class AgendaFileReader:
@@ -36,13 +121,13 @@ class AgendaFileReader:
         self.agenda_file_id = agenda_file_id
         self.table_number = table_number
 
-    def get_linked_folders(self) -> List[str]:
+    def get_linked_folders(self) -> List[Folder]:
         '''
-        Returns a list of ids for folders linked in the Google Drive 
-        file with the input agenda file id.
+        Returns a list of folders linked in the Google Drive file with
+        the input agenda file id.
 
         Returns:
-            List[str]: a list of linked Google Drive folder ids
+            List[Folder]: a list of linked Google Drive folders
             agenda_file_id (str): id of the agenda file to be read
             table_number (int): the index of the table (1-indexed) from 
                 which to read folder links. 0 if links should not be 
@@ -50,43 +135,63 @@ class AgendaFileReader:
         '''
         folders = []
 
-        html = self.service.files().export_media(
-            fileId=self.agenda_file_id,
-            mimeType='text/html'
-        ).execute()
-        soup = BeautifulSoup(html, 'html.parser')
+        parser = lxml.html.HTMLParser()
+        chunk = io.BytesIO()
+        downloader = MediaIoBaseDownload(
+            chunk,
+            self.service.files().export_media(
+                fileId=self.agenda_file_id,
+                mimeType='text/html'
+            ),
+            chunksize=_DOWNLOAD_CHUNK_SIZE
+        )
+        done = False
+        while not done:
+            _, done = downloader.next_chunk(num_retries=_NUM_RETRIES)
+            # Parse each downloaded chunk as it arrives instead of
+            # buffering the whole export
+            parser.feed(chunk.getvalue())
+            chunk.seek(0)
+            chunk.truncate()
+
+        try:
+            root = parser.close()
+        except etree.XMLSyntaxError as e:
+            self.logger.error('Failed to parse the agenda file: %s', e)
+            return folders
+        if root is None:
+            # Nothing was parsed from an empty export
+            self.logger.error('The agenda file is empty')
+            return folders
+
         if self.table_number != 0:
-            soup = soup.select_one(
-                'table:nth-of-type({})'.format(self.table_number)
-            )
-            if soup is None:
+            tables = _NTH_TABLE_XPATH(root, n=self.table_number)
+            if len(tables) == 0:
                 self.logger.error(
                     'Table #%d could not be found in the agenda file',
                     self.table_number
                 )
                 return folders
+            root = tables[0]
 
-        for link in soup.find_all('a', href=True):
-            href = link['href']
-
-            # Extract folder ids from links in HTML exported through
-            # Google Drive API.
-            folder_id_pattern = 'q=https://drive.google.com/.*/folders/(.*?)[&?]'
-            folder_id_matches = re.search(folder_id_pattern, href)
+        for link in _FOLDER_LINKS_XPATH(root):
+            folder_id_matches = _FOLDER_ID_RE.search(link.get('href'))
 
             if folder_id_matches is not None:
+                # text_content() returns an lxml smart string, which is
+                # copied so the folder name holds no lxml objects
                 folders.append(
-                    {
-                        'id': folder_id_matches.group(1),
-                        'name': str(link.contents[0])
-                    }
+                    Folder(
+                        folder_id_matches.group(1),
+                        str(link.text_content())
+                    )
                 )
             else:
                 # Folder id could not be identified from link. Link may
                 # not be to a folder.
                 self.logger.debug(
                     'No folder id found for \'%s\' - skipping link',
-                    link.text
+                    link.text_content()
                 )
 
         return folders
@@ -102,7 +207,7 @@ class KeywordFileSearcher:
         self,
         service: Resource,
         logger: Logger,
-        keywords: List[str]
+        keywords: Sequence[str]
     ) -> None:
         '''
         Constructs necessary attributes for the keyword file 
@@ -112,90 +217,181 @@ class KeywordFileSearcher:
             service (Resource): object with methods for interacting with
                 the Google Drive API
             logger (Logging): logger instance to use for logging
-            keywords (List[str]): keywords to search for in file names
+            keywords (Sequence[str]): keywords to search for in file
+                names
         '''
         self.service = service
         self.logger = logger
         self.keywords = keywords
+        # Matches any of the casefolded keywords in a single scan of a
+        # casefolded file name
+        self.keyword_pattern = re.compile(
+            '|'.join(re.escape(keyword.casefold()) for keyword in keywords)
+        )
+        # Listings of folders that have already been searched, by id
+        self.listing_cache: Dict[str, List[dict]] = {}
+        # Folder searches started by the last call to find_matching_files
+        self.searches: List[Future] = []
 
     def find_matching_files_in_folder(
         self,
         folder_id: str,
-    ) -> List[str]:
+    ) -> List[FileRef]:
         '''
-        Returns a list of ids for files within the input folder that
-        have names with at least one keyword
+        Returns a list of files within the input folder that have names
+        with at least one keyword
 
         Args:
             folder_id (str): a Google Drive folder id
 
         Returns:
-            List[str]: a list of ids for Google Drive files within the 
+            List[FileRef]: a list of Google Drive files within the 
                 specified folder that have names containing at least one
                 keyword
         '''
-        file_ids = []
-        results = self.service.files().list(
-            q=f'\'{folder_id}\' in parents',
-            fields='files(id, name, mimeType)'
-        ).execute()
-
-        files = results['files']
-        pdf_files = [file for file in files
-                     if file['mimeType'] == 'application/pdf']
-        if len(pdf_files) == 0:
+        while True:
+            files = self._list_folder(folder_id)
+            pdf_files = [file for file in files
+                         if file['mimeType'] == 'application/pdf']
+            if len(pdf_files) != 0:
+                break
+
             # Folder does not contain any direct file children. Check 
             # for subfolders.
             folders = [
                 file for file in files
                 if file['mimeType'] == 'application/vnd.google-apps.folder'
             ]
-            if len(folders) != 0:
-                # Find latest folder alphabetically, assuming that
-                # folder names are version names.
-                last_folder = max(
-                    folders,
-                    key=lambda folder: folder['name']
-                )
-                return self.find_matching_files_in_folder(last_folder['id'])
+            if len(folders) == 0:
+                break
 
+            # Descend into the latest folder alphabetically, assuming
+            # that folder names are version names.
+            folder_id = max(folders, key=itemgetter('name'))['id']
+
+        file_ids = []
         for file in pdf_files:
-            for keyword in self.keywords:
-                if keyword.casefold() in file['name'].casefold():
-                    file_ids.append((file['id'], file['name']))
-                    break
+            name = file['name']
+            # lower() is cheaper than casefold() and equivalent for
+            # ASCII names
+            folded_name = name.lower() if name.isascii() else name.casefold()
+            if self.keyword_pattern.search(folded_name):
+                file_ids.append(FileRef(file['id'], file['name']))
         return file_ids
 
+    def _list_folder(self, folder_id: str) -> List[dict]:
+        '''
+        Returns the PDF files and folders within the input folder
+
+        Args:
+            folder_id (str): a Google Drive folder id
+
+        Returns:
+            List[dict]: the ids, names and MIME types of the PDF files
+                and folders within the specified folder
+        '''
+        if folder_id in self.listing_cache:
+            return self.listing_cache[folder_id]
+
+        files = []
+        page_token = None
+        while True:
+            results = self.service.files().list(
+                q=f'\'{folder_id}\' in parents '
+                'and trashed = false '
+                'and (mimeType = \'application/pdf\' '
+                'or mimeType = \'application/vnd.google-apps.folder\')',
+                fields='nextPageToken, files(id, name, mimeType)',
+                pageSize=_MAX_PAGE_SIZE,
+                pageToken=page_token
+            ).execute(num_retries=_NUM_RETRIES)
+            files.extend(results['files'])
+
+            page_token = results.get('nextPageToken')
+            if page_token is None:
+                self.listing_cache[folder_id] = files
+                return files
+
     def find_matching_files(
         self,
-        folders: List[str]
-    ) -> List[str]:
+        folders: List[Folder]
+    ) -> Iterator[List[FileRef]]:
         '''
-        Returns a list of ids for files from the input folders that have
-        names with at least one of keyword
+        Returns an iterator over the files from each of the input 
+        folders that have names with at least one of keyword
+
+        The folders are searched concurrently in the background as soon
+        as this method is called, so the searches overlap with any work
+        done before the iterator is consumed.
 
         Args:
-            folders (List[str]): a list of Google Drive folder ids
+            folders (List[Folder]): a list of Google Drive folders
         Returns:
-            List[str]: a list of ids for Google Drive files from the 
+            Iterator[List[FileRef]]: Google Drive files from each of the
                 specified folders that have names containing at least 
-                one keyword
+                one keyword, in the order of the folders
         '''
-        file_ids = []
-        for folder in folders:
-            matching_file_ids = self.find_matching_files_in_folder(
-                folder['id']
-            )
-            if not matching_file_ids:
-                self.logger.warning(
-                    ('No matching files found in folder with name=\'%s\', '
-                     'id=%s',),
-                    folder['name'],
-                    folder['id']
-                )
-                continue
-            file_ids.append(matching_file_ids)
-        return file_ids
+        executor = ThreadPoolExecutor(max_workers=_MAX_WORKERS)
+        self.searches = [
+            executor.submit(self.find_matching_files_in_folder, folder.id)
+            for folder in folders
+        ]
+        # Submitted searches still run to completion after shutdown,
+        # unless they are cancelled with cancel_searches
+        executor.shutdown(wait=False)
+        return self._collect_matching_files(folders, self.searches)
+
+    def cancel_searches(self) -> None:
+        '''
+        Cancels the folder searches started by find_matching_files that
+        have not started running yet
+        '''
+        for future in self.searches:
+            future.cancel()
+
+    def _collect_matching_files(
+        self,
+        folders: List[Folder],
+        futures: List[Future]
+    ) -> Iterator[List[FileRef]]:
+        '''
+        Yields the results of folder searches in the order of the 
+        folders, as soon as each result is available
+
+        Args:
+            folders (List[Folder]): the searched Google Drive folders
+            futures (List[Future]): the pending searches of the folders
+
+        Yields:
+            List[FileRef]: Google Drive files from one of the specified
+                folders that have names containing at least one keyword
+        '''
+        try:
+            for folder, future in zip(folders, futures):
+                try:
+                    matching_file_ids = future.result()
+                except HttpError as e:
+                    self.logger.error(
+                        'Failed to search folder with name=\'%s\', '
+                        'id=%s: %s',
+                        folder.name,
+                        folder.id,
+                        e
+                    )
+                    continue
+                if not matching_file_ids:
+                    self.logger.warning(
+                        'No matching files found in folder with '
+                        'name=\'%s\', id=%s',
+                        folder.name,
+                        folder.id
+                    )
+                    continue
+                yield matching_file_ids
+        finally:
+            # Stop issuing Drive API calls if iteration is abandoned
+            for future in futures:
+                future.cancel()
 
 
 class OutputFolderWriter:
@@ -237,66 +433,219 @@ class OutputFolderWriter:
 
         Returns:
             str: the id of the created folder
-        '''
-        results = self.service.files().list(
-            q=f'\'{self.output_folder_parent}\' in parents '
-            f'and name = \'{self.output_folder_name}\' '
-            'and mimeType = \'application/vnd.google-apps.folder\' '
-            'and trashed = false',
-            fields='files(id, name)'
-        ).execute()
 
-        for result in results['files']:
-            self.logger.info(
-                'Deleting folder with name=\'%s\', id=%s',
-                result['name'],
-                result['id']
+        Raises:
+            RuntimeError: if the output folder could not be created
+        '''
+        # Existing folders are listed in the same batch request that
+        # creates the output folder, to save a round trip. The listing
+        # may include the created folder.
+        existing_folders, output_folder = self._execute_batch([
+            self.service.files().list(
+                q=f'\'{self.output_folder_parent}\' in parents '
+                f'and name = \'{self.output_folder_name}\' '
+                'and mimeType = \'application/vnd.google-apps.folder\' '
+                'and trashed = false',
+                fields='files(id, name)'
+            ),
+            self.service.files().create(
+                body={
+                    'name': self.output_folder_name,
+                    'parents': [self.output_folder_parent],
+                    'mimeType': 'application/vnd.google-apps.folder'
+                },
+                fields='id'
+            )
+        ])
+        if output_folder is None:
+            raise RuntimeError('Failed to create the output folder')
+
+        if existing_folders is not None:
+            self._execute_in_batches(
+                self._delete_folder_requests(
+                    [folder for folder in existing_folders['files']
+                     if folder['id'] != output_folder['id']]
+                )
             )
-            self.service.files().delete(fileId=result['id']).execute()
-
-        output_folder = self.service.files().create(
-            body={
-                'name': self.output_folder_name,
-                'parents': [self.output_folder_parent],
-                'mimeType': 'application/vnd.google-apps.folder'
-            },
-            fields='id'
-        ).execute()
 
         return output_folder['id']
 
     def create_output_folder_with_files(
         self,
-        file_ids: List[str]
+        file_ids: Iterable[List[FileRef]],
+        max_group_count: int
     ) -> None:
         '''
         Creates an output directory containing copies of the specified
         Google Drive files
 
+        Files are copied as groups are produced by the input iterable
+
         Args:
-            file_ids (List[str]): the ids of Google Drive files to copy
+            file_ids (Iterable[List[FileRef]]): groups of Google Drive
+                files to copy, in agenda order
+            max_group_count (int): the maximum number of groups in
+                file_ids, used to zero-pad the prefixes of copied files
         '''
         output_folder_id = self.create_empty_output_folder()
 
-        i = 0
-        for id_group in file_ids:
-            for id_name_pair in id_group:
+        self._execute_in_batches(
+            self._copy_file_requests(
+                file_ids,
+                max_group_count,
+                output_folder_id
+            )
+        )
+        self.logger.info(
+            'Finished copying files to the output folder with id=%s',
+            output_folder_id
+        )
+
+    def _delete_folder_requests(
+        self,
+        folders: List[dict]
+    ) -> Iterator[HttpRequest]:
+        '''
+        Yields requests for deleting the specified Google Drive folders
+
+        Args:
+            folders (List[dict]): Google Drive folders with ids and 
+                names
+
+        Yields:
+            HttpRequest: a request for deleting a folder
+        '''
+        for folder in folders:
+            self.logger.info(
+                'Deleting folder with name=\'%s\', id=%s',
+                folder['name'],
+                folder['id']
+            )
+            yield self.service.files().delete(fileId=folder['id'])
+
+    def _copy_file_requests(
+        self,
+        file_ids: Iterable[List[FileRef]],
+        max_group_count: int,
+        output_folder_id: str
+    ) -> Iterator[HttpRequest]:
+        '''
+        Yields requests for copying the specified Google Drive files to
+        the output folder
+
+        Copied files are prefixed with the zero-padded index of their
+        group, so that they sort in agenda order by name
+
+        Args:
+            file_ids (Iterable[List[FileRef]]): groups of Google Drive
+                files to copy, in agenda order
+            max_group_count (int): the maximum number of groups in
+                file_ids
+            output_folder_id (str): the id of the output folder
+
+        Yields:
+            HttpRequest: a request for copying a file
+        '''
+        width = len(str(max(max_group_count - 1, 0)))
+        for i, id_group in enumerate(file_ids):
+            prefix = f'{i:0{width}d}. '
+            for file_ref in id_group:
                 self.logger.debug(
                     'Copying \'%s\' to the output folder',
-                    id_name_pair[1]
+                    file_ref.name
                 )
-                self.service.files().copy(
-                    fileId=id_name_pair[0],
+                yield self.service.files().copy(
+                    fileId=file_ref.id,
                     body={
-                        'name': '%d. %s' % (i, id_name_pair[1]),
+                        'name': prefix + file_ref.name,
                         'parents': [output_folder_id]
-                    }
-                ).execute()
-            i += 1
-        self.logger.info(
-            'Successfully copied files to the output folder with id=%s',
-            output_folder_id
-        )
+                    },
+                    fields='id'
+                )
+
+    def _execute_in_batches(self, requests: Iterable[HttpRequest]) -> None:
+        '''
+        Executes Google Drive API requests in batch requests of up to the
+        maximum batch size
+
+        Args:
+            requests (Iterable[HttpRequest]): the requests to execute
+        '''
+        batch = []
+        try:
+            for request in requests:
+                batch.append(request)
+                if len(batch) == _MAX_BATCH_SIZE:
+                    full_batch, batch = batch, []
+                    self._execute_batch(full_batch)
+        finally:
+            # Requests generated before a failure are still executed
+            if len(batch) != 0:
+                self._execute_batch(batch)
+
+    def _execute_batch(
+        self,
+        requests: List[HttpRequest]
+    ) -> List[Optional[Any]]:
+        '''
+        Executes Google Drive API requests in a single batch request
+
+        Requests that fail because of rate limiting or server errors are
+        retried with exponential backoff. Other failures are logged.
+
+        Args:
+            requests (List[HttpRequest]): the requests to execute
+
+        Returns:
+            List[Optional[Any]]: the response of each request, or None
+                for requests that failed
+
+        Raises:
+            HttpError: if the batch request itself fails with an error
+                that cannot be retried
+        '''
+        responses: List[Optional[Any]] = [None] * len(requests)
+        errors: Dict[int, HttpError] = {}
+
+        def record_response(
+            request_id: str,
+            response: Any,
+            exception: Optional[HttpError]
+        ) -> None:
+            if exception is None:
+                responses[int(request_id)] = response
+            else:
+                errors[int(request_id)] = exception
+
+        pending = list(range(len(requests)))
+        for retry_num in range(_NUM_RETRIES + 1):
+            if retry_num > 0:
+                time.sleep(2 ** retry_num + random.random())
+
+            errors.clear()
+            batch = self.service.new_batch_http_request(
+                callback=record_response
+            )
+            for i in pending:
+                batch.add(requests[i], request_id=str(i))
+            try:
+                batch.execute()
+            except HttpError as e:
+                if retry_num < _NUM_RETRIES and _is_retryable(e):
+                    continue
+                raise
+
+            pending = []
+            for i, error in errors.items():
+                if retry_num < _NUM_RETRIES and _is_retryable(error):
+                    pending.append(i)
+                else:
+                    self.logger.error('Drive API request failed: %s', error)
+
+            if len(pending) == 0:
+                break
+
+        return responses
 
 
 class AgendaProcessor:
@@ -337,4 +686,12 @@ class AgendaProcessor:
 
         if len(folders) != 0:
             file_ids = self.keyword_file_searcher.find_matching_files(folders)
-            self.output_folder_writer.create_output_folder_with_files(file_ids)
+            try:
+                self.output_folder_writer.create_output_folder_with_files(
+                    file_ids,
+                    len(folders)
+                )
+            finally:
+                # The searches may not have been consumed if the output
+                # folder could not be prepared
+                self.keyword_file_searcher.cancel_searches()
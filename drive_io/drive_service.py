@@ -1,9 +1,12 @@
-import os.path
+import functools
+import threading
 
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build, Resource
+from googleapiclient.http import build_http, HttpRequest
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/drive']
@@ -11,10 +14,13 @@ TOKEN_FILE = 'token.json'
 CREDENTIALS_FILE = 'credentials.json'
 
 
+@functools.lru_cache(maxsize=1)
 def create_service() -> Resource:
     '''
     Creates a Resource for interacting with the Google Drive API
 
+    The Resource is created once and reused by subsequent calls
+
     Returns:
         Resource: object with methods for interacting with the Google 
             Drive API
@@ -26,12 +32,13 @@ def create_service() -> Resource:
         ValueError: If the credentials file is not in the expected 
             format
     '''
-    creds = None
     # The file token.json stores the user's access and refresh tokens,
     # and is created automatically when the authorization flow completes
     # for the first time.
-    if os.path.exists(TOKEN_FILE):
+    try:
         creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    except FileNotFoundError:
+        creds = None
     # If (valid) credentials are not available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -46,4 +53,26 @@ def create_service() -> Resource:
         with open(TOKEN_FILE, 'w') as token:
             token.write(creds.to_json())
 
-    return build('drive', 'v3', credentials=creds)
+    # httplib2.Http objects are not thread-safe, so each thread sends its
+    # requests through its own authorized Http object, which keeps its
+    # connections open between requests.
+    thread_local = threading.local()
+
+    def get_http() -> AuthorizedHttp:
+        if not hasattr(thread_local, 'http'):
+            thread_local.http = AuthorizedHttp(creds, http=build_http())
+        return thread_local.http
+
+    def build_request(http, *args, **kwargs) -> HttpRequest:
+        return HttpRequest(get_http(), *args, **kwargs)
+
+    return build(
+        'drive',
+        'v3',
+        http=get_http(),
+        requestBuilder=build_request,
+        # Use the discovery document bundled with googleapiclient
+        # instead of fetching it over the network
+        cache_discovery=False,
+        static_discovery=True
+    )
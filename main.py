@@ -73,7 +73,10 @@ def main() -> None:
         google_logger = logging.getLogger('googleapiclient')
         google_logger.setLevel(googleapiclient_logging_level)
         agenda_file_id = config.get('agenda_file', 'id')
-        keywords = config.get('keywords', 'keywords')
+        keywords = tuple(
+            keyword.strip()
+            for keyword in config.get('keywords', 'keywords').split(',')
+        )
         output_folder_parent = config.get('output', 'parent_id')
         output_folder_name = config.get('output', 'folder_name')
     except (NoSectionError, NoOptionError) as e:
@@ -95,7 +98,6 @@ def main() -> None:
             e)
         sys.exit(1)
 
-    keywords = [keyword.strip() for keyword in keywords.split(',')]
     agenda_processor = AgendaProcessor(
         AgendaFileReader(service, logger, agenda_file_id, table_number),
         KeywordFileSearcher(service, logger, keywords),